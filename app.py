@@ -1,69 +1,284 @@
 from __future__ import annotations
 
+import base64
+import gzip
+import hashlib
+import hmac
+import itertools
 import json
 import os
 import random
+import secrets
 import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import Executor
 from datetime import date, datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-from flask import Flask, jsonify, request
+import click
+import numpy as np
+from flask import Flask, Response, g, jsonify, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import check_password_hash, generate_password_hash
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional speedup
+    brotli = None
+
+
+class CompactJSONProvider(DefaultJSONProvider):
+    """JSON provider that emits compact UTF-8 output, using orjson when installed."""
+
+    ensure_ascii = False
+    sort_keys = False
+    compact = True
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if orjson is not None and "indent" not in kwargs:
+            return orjson.dumps(obj, default=self.default).decode("utf-8")
+        kwargs.setdefault("separators", (",", ":"))
+        return super().dumps(obj, **kwargs)
+
+
 app = Flask(__name__)
+app.json = CompactJSONProvider(app)
 CORS(app)
 
 DB_NAME = "fitness_coach.db"
 
+# User-scoped tables are spread over USER_SHARD_COUNT SQLite files by a hash
+# of the user id; DB_NAME keeps the read-mostly catalog and the user
+# directory. With a single shard everything stays in DB_NAME.
+USER_SHARD_COUNT = int(os.environ.get("USER_SHARD_COUNT", 1))
+USER_SHARD_PATTERN = os.environ.get("USER_SHARD_PATTERN", "fitness_coach_users_{}.db")
+# The ASGI entry point (asgi.py) reuses one connection per thread and per
+# database file, and hands password hashing to a process pool.
+REUSE_THREAD_CONNECTIONS = False
+password_executor: Optional[Executor] = None
+_thread_connections = threading.local()
+
+USER_TABLES = ("users", "user_preferences", "subscriptions", "subscription_events", "user_ad_impressions")
+
+COMPRESSION_MIN_SIZE = 512
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Serialized catalog responses keyed by (endpoint, params). Each entry maps a
+# content encoding ("identity", "gzip", "br") to the encoded body so repeated
+# plan requests skip both the query and the compression step. The key holds
+# client-supplied values, so the cache is an LRU capped at
+# CATALOG_CACHE_MAX_ENTRIES.
+CATALOG_CACHE_MAX_ENTRIES = 256
+_catalog_cache: "OrderedDict[Tuple, Dict[str, bytes]]" = OrderedDict()
+_catalog_cache_lock = threading.Lock()
+
+# Reference image embeddings for machine recognition are kept as one
+# L2-normalized float32 matrix per worker, ordered by guide so the best score
+# per guide can be reduced with np.maximum.reduceat. Set EMBEDDING_INDEX_PATH
+# to share one copy between workers: `flask import-embeddings` writes the
+# index there (atomically, so mapped files are never truncated) and workers
+# only memory-map it. Without the file each worker builds its own matrix.
+EMBEDDING_INDEX_PATH = os.environ.get("EMBEDDING_INDEX_PATH")
+EMBEDDING_INDEX_TTL = 300
+EMBEDDING_MIN_SIMILARITY = 0.6
+EMBEDDING_MAX_TOP_K = 10
+
+_embedding_index: Optional[Dict[str, Any]] = None
+_embedding_index_lock = threading.Lock()
+
+# Access tokens are HMAC-signed so every worker can verify them without a
+# database lookup. SECRET_KEY must be set outside debug/testing, otherwise
+# each worker would sign with its own key and reject the others' tokens.
+SECRET_KEY = os.environ.get("SECRET_KEY", "").encode("utf-8")
+ACCESS_TOKEN_TTL = 12 * 60 * 60
+REVOCATION_PRUNE_THRESHOLD = 10_000
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Endpoints that require a valid access token. Other endpoints accept one.
+AUTH_REQUIRED_ENDPOINTS = {
+    "upsert_preferences",
+    "get_preferences",
+    "get_subscription",
+    "update_subscription",
+    "get_daily_ad",
+    "export_user_data",
+    "logout",
+}
+
+# Revoked token ids mapped to their expiry. Revocations are written to the
+# revoked_tokens table and every worker copies new rows on each scheduler
+# poll, so a revocation reaches other workers within
+# SUBSCRIPTION_EVENT_POLL_INTERVAL. Entries are dropped once the token would
+# have expired anyway; the map therefore holds the revocations of at most one
+# ACCESS_TOKEN_TTL and is pruned whenever it doubles past
+# REVOCATION_PRUNE_THRESHOLD.
+_revoked_tokens: Dict[str, int] = {}
+_revoked_tokens_lock = threading.Lock()
+_revoked_tokens_prune_at = REVOCATION_PRUNE_THRESHOLD
+_last_revocation_id = 0
+_dev_secret_key = secrets.token_bytes(32)
+
+# Due subscriptions are swept in bulk rather than checked per request. Run
+# `flask sweep-subscriptions` from cron, or set SUBSCRIPTION_SWEEPER=1 on
+# exactly one process to sweep in the background. Every worker polls
+# subscription_events so tokens carrying a stale tier are rejected.
+SUBSCRIPTION_PERIOD_DAYS = 30
+SUBSCRIPTION_SWEEPER = os.environ.get("SUBSCRIPTION_SWEEPER") == "1"
+SUBSCRIPTION_SWEEP_INTERVAL = 15 * 60
+SUBSCRIPTION_SWEEP_CHUNK = 500
+SUBSCRIPTION_EVENT_POLL_INTERVAL = 30
+SUBSCRIPTION_EVENT_RETENTION = 2 * ACCESS_TOKEN_TTL
+
+subscription_listeners: List[Callable[[List[Tuple[int, str, int]]], None]] = []
+_last_subscription_event_ids: Dict[int, int] = {}
+_tier_changed_at: Dict[int, int] = {}
+_scheduler_started = False
+_scheduler_lock = threading.Lock()
+
+# Login attempts are throttled per e-mail and per client IP with token
+# buckets. Set RATE_LIMIT_DB to a SQLite path shared by all workers so the
+# limits hold across processes; otherwise each worker keeps its own buckets.
+RATE_LIMIT_DB = os.environ.get("RATE_LIMIT_DB")
+LOGIN_EMAIL_BUCKET = (5, 5 / 300)  # capacity, tokens refilled per second
+LOGIN_IP_BUCKET = (20, 20 / 60)
+RATE_LIMIT_MAX_KEYS = 100_000
+
+# Number of reverse proxies in front of the app. Their
+# X-Forwarded-For entries are trusted for the client IP; with 0 the socket
+# address is used, which behind a proxy puts every client in one IP bucket.
+TRUSTED_PROXY_COUNT = int(os.environ.get("TRUSTED_PROXY_COUNT", 0))
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+
+# /api/metrics/login-limiter answers only requests carrying this value in
+# the X-Metrics-Token header, and is disabled when it is unset.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
 
 def get_db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_NAME)
+    return _connect(DB_NAME)
+
+
+class ThreadConnection(sqlite3.Connection):
+    """Connection kept open for the next request on the same thread."""
+
+    def close(self) -> None:
+        if self.in_transaction:
+            self.rollback()
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    if REUSE_THREAD_CONNECTIONS:
+        cache = _thread_connections.__dict__
+        conn = cache.get(path)
+        if conn is None:
+            conn = cache[path] = sqlite3.connect(path, factory=ThreadConnection)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    conn = sqlite3.connect(path)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON")
     return conn
 
 
+def shard_path(index: int, shard_count: int = USER_SHARD_COUNT, pattern: str = USER_SHARD_PATTERN) -> str:
+    return DB_NAME if shard_count == 1 else pattern.format(index)
+
+
+def shard_for_user(user_id: int, shard_count: int = USER_SHARD_COUNT) -> int:
+    return zlib.crc32(int(user_id).to_bytes(8, "little", signed=True)) % shard_count
+
+
+def get_shard_db(index: int) -> sqlite3.Connection:
+    return _connect(shard_path(index))
+
+
+def get_user_db(user_id: int) -> sqlite3.Connection:
+    return get_shard_db(shard_for_user(user_id))
+
+
+def fan_out(sql: str, params: Tuple = ()) -> Iterator[Tuple[int, sqlite3.Row]]:
+    """Run a read query on every shard and yield (shard index, row) pairs."""
+    for index in range(USER_SHARD_COUNT):
+        conn = get_shard_db(index)
+        try:
+            for row in conn.execute(sql, params):
+                yield index, row
+        finally:
+            conn.close()
+
+
 def init_db() -> None:
     conn = get_db()
-    cursor = conn.cursor()
+    # WAL lets readers proceed while the subscription sweeper holds the write lock.
+    conn.execute("PRAGMA journal_mode = WAL")
+    create_catalog_schema(conn.cursor())
+    conn.commit()
+    conn.close()
+
+    for index in range(USER_SHARD_COUNT):
+        conn = get_shard_db(index)
+        conn.execute("PRAGMA journal_mode = WAL")
+        create_user_schema(conn.cursor())
+        conn.commit()
+        conn.close()
 
+    _backfill_user_directory()
+    seed_initial_content()
+
+
+def _backfill_user_directory() -> None:
+    # Databases created before the directory existed already have users.
+    conn = get_db()
+    if conn.execute("SELECT 1 FROM user_directory LIMIT 1").fetchone() is None:
+        conn.executemany(
+            "INSERT OR IGNORE INTO user_directory (id, email) VALUES (?, ?)",
+            ((row["id"], row["email"]) for _, row in fan_out("SELECT id, email FROM users")),
+        )
+        conn.commit()
+    conn.close()
+
+
+def create_catalog_schema(cursor: sqlite3.Cursor) -> None:
+    # Maps e-mail addresses to globally unique user ids so login can find
+    # the right shard. Only registration writes to it, but since it lives in
+    # the catalog database every registration still takes that file's single
+    # write lock, however many shards there are.
     cursor.execute(
         """
-        CREATE TABLE IF NOT EXISTS users (
+        CREATE TABLE IF NOT EXISTS user_directory (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            name TEXT,
-            created_at TEXT NOT NULL,
-            updated_at TEXT NOT NULL
+            email TEXT UNIQUE NOT NULL
         )
         """
     )
 
     cursor.execute(
         """
-        CREATE TABLE IF NOT EXISTS user_preferences (
-            user_id INTEGER PRIMARY KEY,
-            primary_goal TEXT,
-            experience_level TEXT,
-            dietary_preference TEXT,
-            allergies TEXT,
-            training_frequency INTEGER DEFAULT 3,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            jti TEXT NOT NULL,
+            expires_at INTEGER NOT NULL
         )
         """
     )
-
     cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            user_id INTEGER PRIMARY KEY,
-            tier TEXT NOT NULL,
-            renewal_date TEXT,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-        )
-        """
+        "CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires_at ON revoked_tokens (expires_at)"
     )
 
     cursor.execute(
@@ -82,6 +297,7 @@ def init_db() -> None:
         )
         """
     )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_workouts_goal_level ON workouts (goal, level)")
 
     cursor.execute(
         """
@@ -99,6 +315,7 @@ def init_db() -> None:
         )
         """
     )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_meals_goal_diet_type ON meals (goal, diet_type)")
 
     cursor.execute(
         """
@@ -128,6 +345,86 @@ def init_db() -> None:
         """
     )
 
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS machine_embeddings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guide_id INTEGER NOT NULL,
+            vector BLOB NOT NULL,
+            FOREIGN KEY (guide_id) REFERENCES machine_guides(id) ON DELETE CASCADE
+        )
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_machine_embeddings_guide ON machine_embeddings (guide_id)"
+    )
+
+
+def create_user_schema(cursor: sqlite3.Cursor) -> None:
+    # Ads live in the catalog database, so impressions cannot reference them
+    # with a foreign key.
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            name TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        """
+    )
+
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_preferences (
+            user_id INTEGER PRIMARY KEY,
+            primary_goal TEXT,
+            experience_level TEXT,
+            dietary_preference TEXT,
+            allergies TEXT,
+            training_frequency INTEGER DEFAULT 3,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """
+    )
+
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id INTEGER PRIMARY KEY,
+            tier TEXT NOT NULL,
+            renewal_date TEXT,
+            auto_renew INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+        """
+    )
+    cursor.execute("PRAGMA table_info(subscriptions)")
+    if "auto_renew" not in {row["name"] for row in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE subscriptions ADD COLUMN auto_renew INTEGER NOT NULL DEFAULT 0")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_renewal_date ON subscriptions (renewal_date)"
+    )
+
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS subscription_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            tier TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+        """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_subscription_events_created_at ON subscription_events (created_at)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_subscription_events_user ON subscription_events (user_id)"
+    )
+
     cursor.execute(
         """
         CREATE TABLE IF NOT EXISTS user_ad_impressions (
@@ -135,16 +432,13 @@ def init_db() -> None:
             user_id INTEGER NOT NULL,
             ad_id INTEGER NOT NULL,
             served_on TEXT NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-            FOREIGN KEY (ad_id) REFERENCES ads(id) ON DELETE CASCADE
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
         )
         """
     )
-
-    conn.commit()
-    conn.close()
-
-    seed_initial_content()
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_ad_impressions_user_served ON user_ad_impressions (user_id, served_on)"
+    )
 
 
 def seed_initial_content() -> None:
@@ -462,6 +756,18 @@ def seed_initial_content() -> None:
     conn.close()
 
 
+def hash_password(password: str) -> str:
+    if password_executor is None:
+        return generate_password_hash(password)
+    return password_executor.submit(generate_password_hash, password).result()
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    if password_executor is None:
+        return check_password_hash(password_hash, password)
+    return password_executor.submit(check_password_hash, password_hash, password).result()
+
+
 def row_to_dict(row: sqlite3.Row) -> Dict:
     return {key: row[key] for key in row.keys()}
 
@@ -475,6 +781,728 @@ def parse_json_field(field: Optional[str]) -> List[str]:
         return []
 
 
+def cached_catalog_response(key: Tuple) -> Optional[Response]:
+    with _catalog_cache_lock:
+        entry = _catalog_cache.get(key)
+        if entry is None:
+            return None
+        _catalog_cache.move_to_end(key)
+    g.catalog_cache_key = key
+    return app.response_class(entry["identity"], mimetype="application/json")
+
+
+def store_catalog_response(key: Tuple, response: Response) -> Response:
+    with _catalog_cache_lock:
+        _catalog_cache[key] = {"identity": response.get_data()}
+        _catalog_cache.move_to_end(key)
+        while len(_catalog_cache) > CATALOG_CACHE_MAX_ENTRIES:
+            _catalog_cache.popitem(last=False)
+    g.catalog_cache_key = key
+    return response
+
+
+def _negotiate_encoding() -> Optional[str]:
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(offered)
+
+
+def _encode_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _load_embedding_rows() -> Tuple[np.ndarray, np.ndarray]:
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT guide_id, vector FROM machine_embeddings ORDER BY guide_id, id")
+    guide_ids: List[int] = []
+    blobs: List[bytes] = []
+    for row in cursor:
+        guide_ids.append(row["guide_id"])
+        blobs.append(row["vector"])
+    conn.close()
+
+    # Rows whose length differs from the common one (e.g. from an older model)
+    # are left out rather than breaking the index for every request.
+    lengths = Counter(len(blob) for blob in blobs if blob and len(blob) % 4 == 0)
+    if lengths:
+        size = lengths.most_common(1)[0][0]
+        kept = [i for i, blob in enumerate(blobs) if len(blob) == size]
+        if len(kept) < len(blobs):
+            app.logger.warning("Hoppar över %d embeddings med fel dimension", len(blobs) - len(kept))
+            guide_ids = [guide_ids[i] for i in kept]
+            blobs = [blobs[i] for i in kept]
+        matrix = np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), size // 4)
+        matrix = _normalize_rows(matrix).astype(np.float32)
+    else:
+        guide_ids = []
+        matrix = np.zeros((0, 0), dtype=np.float32)
+    return np.asarray(guide_ids, dtype=np.int64), matrix
+
+
+def write_embedding_index_file(path: str) -> int:
+    """Write the normalized index to ``path`` as one .npy of (guide_id, vector) records."""
+    ids, matrix = _load_embedding_rows()
+    records = np.empty(len(ids), dtype=[("guide_id", "<i8"), ("vector", "<f4", (matrix.shape[1],))])
+    records["guide_id"] = ids
+    records["vector"] = matrix
+    # Workers may have the old file mapped; replacing it keeps their inode
+    # intact, whereas rewriting it in place would crash them with SIGBUS.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            np.save(handle, records)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(records)
+
+
+def _embedding_source_version() -> Tuple:
+    """A cheap fingerprint of the index source, compared before rebuilding."""
+    if EMBEDDING_INDEX_PATH and os.path.exists(EMBEDDING_INDEX_PATH):
+        stat = os.stat(EMBEDDING_INDEX_PATH)
+        return ("file", stat.st_mtime_ns, stat.st_size)
+    conn = get_db()
+    row = conn.execute("SELECT COUNT(*), MAX(id) FROM machine_embeddings").fetchone()
+    conn.close()
+    return ("db", row[0], row[1])
+
+
+def build_embedding_index() -> Dict[str, Any]:
+    version = _embedding_source_version()
+    if EMBEDDING_INDEX_PATH and os.path.exists(EMBEDDING_INDEX_PATH):
+        records = np.load(EMBEDDING_INDEX_PATH, mmap_mode="r")
+        ids = np.array(records["guide_id"])
+        matrix = records["vector"] if len(ids) else np.zeros((0, 0), dtype=np.float32)
+    else:
+        ids, matrix = _load_embedding_rows()
+
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) else np.zeros(0, dtype=np.int64)
+    return {
+        "matrix": matrix,
+        "starts": starts,
+        "guide_ids": ids[starts],
+        "version": version,
+        "loaded_at": time.time(),
+    }
+
+
+def _refresh_embedding_index(current: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    # Caller holds _embedding_index_lock.
+    global _embedding_index
+    if _embedding_index is None:
+        _embedding_index = build_embedding_index()
+    elif _embedding_index is current:
+        if _embedding_source_version() == current["version"]:
+            _embedding_index = dict(current, loaded_at=time.time())
+        else:
+            _embedding_index = build_embedding_index()
+    return _embedding_index
+
+
+def get_embedding_index() -> Dict[str, Any]:
+    index = _embedding_index
+    if index is None:
+        with _embedding_index_lock:
+            return _refresh_embedding_index(index)
+    # One thread refreshes an expired index; the others keep answering from
+    # the current one instead of queueing on the lock.
+    if time.time() - index["loaded_at"] > EMBEDDING_INDEX_TTL and _embedding_index_lock.acquire(blocking=False):
+        try:
+            return _refresh_embedding_index(index)
+        finally:
+            _embedding_index_lock.release()
+    return index
+
+
+def invalidate_embedding_index() -> None:
+    global _embedding_index
+    with _embedding_index_lock:
+        _embedding_index = None
+
+
+def parse_embedding(value: Any) -> Optional[np.ndarray]:
+    """Accept an embedding as a list of floats or base64-encoded little-endian float32."""
+    try:
+        if isinstance(value, str):
+            vector = np.frombuffer(base64.b64decode(value), dtype="<f4")
+        else:
+            vector = np.asarray(value, dtype=np.float32)
+    except (ValueError, TypeError):
+        return None
+    if vector.ndim != 1 or not vector.size or not np.all(np.isfinite(vector)):
+        return None
+    return vector.astype(np.float32)
+
+
+def nearest_guides(embedding: np.ndarray, top_k: int) -> Optional[List[Tuple[int, float]]]:
+    """Return (guide_id, cosine similarity) pairs for the closest guides, best first.
+
+    Returns None when the embedding dimension does not match the index.
+    """
+    index = get_embedding_index()
+    matrix = index["matrix"]
+    if not len(index["guide_ids"]):
+        return []
+    if embedding.shape[0] != matrix.shape[1]:
+        return None
+
+    norm = np.linalg.norm(embedding)
+    if norm == 0:
+        return []
+    scores = matrix @ (embedding / norm)
+    best = np.maximum.reduceat(scores, index["starts"])
+
+    top_k = min(top_k, len(best))
+    top = np.argpartition(-best, top_k - 1)[:top_k]
+    top = top[np.argsort(-best[top])]
+    return [(int(index["guide_ids"][i]), float(best[i])) for i in top]
+
+
+def store_machine_embeddings(label: str, vectors: np.ndarray) -> int:
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM machine_guides WHERE label = ?", (label,))
+    row = cursor.fetchone()
+    if row is None:
+        conn.close()
+        raise KeyError(label)
+    vectors = np.atleast_2d(np.asarray(vectors, dtype="<f4"))
+    cursor.execute("SELECT length(vector) FROM machine_embeddings LIMIT 1")
+    existing = cursor.fetchone()
+    if vectors.ndim != 2 or not vectors.shape[1]:
+        conn.close()
+        raise ValueError(f"Ogiltig form {vectors.shape}; förväntade en rad per vektor.")
+    # Every stored vector must share one dimension for the index matrix.
+    if existing and existing[0] != vectors.shape[1] * 4:
+        conn.close()
+        raise ValueError(f"Dimension {vectors.shape[1]} matchar inte referensvektorernas {existing[0] // 4}.")
+    cursor.executemany(
+        "INSERT INTO machine_embeddings (guide_id, vector) VALUES (?, ?)",
+        [(row["id"], vector.tobytes()) for vector in vectors],
+    )
+    conn.commit()
+    conn.close()
+    invalidate_embedding_index()
+    return len(vectors)
+
+
+@app.cli.command("import-embeddings")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_embeddings_command(path: str) -> None:
+    """Import reference embeddings from an .npz file keyed by machine label."""
+    init_db()
+    with np.load(path) as archive:
+        for label in archive.files:
+            try:
+                count = store_machine_embeddings(label, archive[label])
+            except KeyError:
+                click.echo(f"Okänd maskin: {label}", err=True)
+                continue
+            except ValueError as error:
+                click.echo(f"{label}: {error}", err=True)
+                continue
+            click.echo(f"{label}: {count} vektorer")
+    if EMBEDDING_INDEX_PATH:
+        count = write_embedding_index_file(EMBEDDING_INDEX_PATH)
+        click.echo(f"Index skrivet till {EMBEDDING_INDEX_PATH} ({count} vektorer)")
+
+
+@app.after_request
+def compress_response(response: Response):
+    if (
+        response.mimetype != "application/json"
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or (response.content_length or 0) < COMPRESSION_MIN_SIZE:
+        return response
+
+    encoding = _negotiate_encoding()
+    if encoding is None:
+        return response
+
+    key = g.get("catalog_cache_key")
+    entry = _catalog_cache.get(key) if key is not None else None
+    body = entry.get(encoding) if entry is not None else None
+    if body is None:
+        body = _encode_body(response.get_data(), encoding)
+        if entry is not None:
+            with _catalog_cache_lock:
+                entry[encoding] = body
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def signing_key() -> bytes:
+    if SECRET_KEY:
+        return SECRET_KEY
+    if app.debug or app.testing:
+        return _dev_secret_key
+    raise RuntimeError("SECRET_KEY måste sättas utanför debug-läge.")
+
+
+# gunicorn exports SERVER_SOFTWARE before loading app:app. Check the key at
+# that point so a misconfigured worker fails to boot instead of answering
+# every token request with a 500; asgi.py does the same on startup.
+if os.environ.get("SERVER_SOFTWARE"):
+    signing_key()
+
+
+def _sign(payload: str) -> str:
+    return _b64encode(hmac.new(signing_key(), payload.encode("ascii"), hashlib.sha256).digest())
+
+
+def issue_access_token(user_id: int, tier: str) -> str:
+    now = int(time.time())
+    claims = {
+        "sub": user_id,
+        "tier": tier,
+        "iat": now,
+        "exp": now + ACCESS_TOKEN_TTL,
+        "jti": secrets.token_urlsafe(12),
+    }
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_access_token(token: str) -> Optional[Dict]:
+    if not token.isascii():
+        return None
+    payload, _, signature = token.partition(".")
+    if not payload or not signature or not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    try:
+        claims = json.loads(_b64decode(payload))
+    except (ValueError, json.JSONDecodeError):
+        return None
+    if claims.get("exp", 0) <= time.time() or claims.get("jti") in _revoked_tokens:
+        return None
+    if claims.get("iat", 0) < _tier_changed_at.get(claims.get("sub"), 0):
+        return None
+    return claims
+
+
+def revoke_token(claims: Dict) -> None:
+    conn = get_db()
+    conn.execute(
+        "INSERT INTO revoked_tokens (jti, expires_at) VALUES (?, ?)",
+        (claims["jti"], claims["exp"]),
+    )
+    conn.execute("DELETE FROM revoked_tokens WHERE expires_at < ?", (int(time.time()),))
+    conn.commit()
+    conn.close()
+    _remember_revocations([(claims["jti"], claims["exp"])])
+
+
+def _remember_revocations(revocations: List[Tuple[str, int]]) -> None:
+    global _revoked_tokens_prune_at
+    now = time.time()
+    with _revoked_tokens_lock:
+        _revoked_tokens.update(revocations)
+        if len(_revoked_tokens) >= _revoked_tokens_prune_at:
+            for jti in [jti for jti, exp in _revoked_tokens.items() if exp <= now]:
+                del _revoked_tokens[jti]
+            _revoked_tokens_prune_at = max(REVOCATION_PRUNE_THRESHOLD, 2 * len(_revoked_tokens))
+
+
+def poll_revoked_tokens() -> None:
+    """Copy revocations made by other workers into this worker's map."""
+    global _last_revocation_id
+    conn = get_db()
+    rows = conn.execute(
+        "SELECT id, jti, expires_at FROM revoked_tokens WHERE id > ? ORDER BY id",
+        (_last_revocation_id,),
+    ).fetchall()
+    conn.close()
+    if rows:
+        _last_revocation_id = rows[-1]["id"]
+        _remember_revocations([(row["jti"], row["expires_at"]) for row in rows])
+
+
+class MemoryBucketStore:
+    """Per-process token buckets stored as (tokens, updated_at) tuples.
+
+    Buckets are kept in least-recently-used order. Once max_keys is reached,
+    each new key evicts the bucket that has gone longest without an attempt,
+    in O(1), so a flood of fresh keys cannot make every check scan the store.
+    """
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS) -> None:
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, capacity: int, rate: float, now: float) -> float:
+        """Take one token from ``key`` and return 0, or the seconds until one is available."""
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if key not in self._buckets and len(self._buckets) >= self.max_keys:
+                self._buckets.popitem(last=False)
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            self._buckets.move_to_end(key)
+            return wait
+
+
+class SQLiteBucketStore:
+    """Token buckets in a SQLite file so every worker shares the same limits."""
+
+    PRUNE_INTERVAL = 60
+    PRUNE_BATCH = 200
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._next_prune = 0.0
+        conn = self._connect()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                full_at REAL NOT NULL DEFAULT 0
+            )
+            """
+        )
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(rate_limits)")}
+        if "full_at" not in columns:
+            conn.execute("ALTER TABLE rate_limits ADD COLUMN full_at REAL NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_limits_full_at ON rate_limits (full_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def consume(self, key: str, capacity: int, rate: float, now: float) -> float:
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT tokens, updated FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limits (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+                (key, tokens, now, now + (capacity - tokens) / rate),
+            )
+            if now >= self._next_prune:
+                # Rows whose bucket has refilled behave exactly like missing rows.
+                # Deleting them in small batches keeps this login's write lock
+                # short; a full batch means more are due, so the next call
+                # continues instead of waiting a whole interval.
+                deleted = conn.execute(
+                    "DELETE FROM rate_limits WHERE key IN (SELECT key FROM rate_limits WHERE full_at < ? LIMIT ?)",
+                    (now, self.PRUNE_BATCH),
+                ).rowcount
+                self._next_prune = now if deleted >= self.PRUNE_BATCH else now + self.PRUNE_INTERVAL
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+login_bucket_store = SQLiteBucketStore(RATE_LIMIT_DB) if RATE_LIMIT_DB else MemoryBucketStore()
+login_limiter_metrics: Dict[str, int] = {"allowed": 0, "rejected_email": 0, "rejected_ip": 0, "store_errors": 0}
+_login_limiter_metrics_lock = threading.Lock()
+
+
+def _count_login_attempt(outcome: str) -> None:
+    with _login_limiter_metrics_lock:
+        login_limiter_metrics[outcome] += 1
+
+
+def check_login_rate_limit(email: str, client_ip: str) -> float:
+    """Return 0 if a login attempt may proceed, otherwise the seconds to wait."""
+    now = time.time()
+    try:
+        wait = login_bucket_store.consume(f"ip:{client_ip}", *LOGIN_IP_BUCKET, now)
+        if wait:
+            _count_login_attempt("rejected_ip")
+            return wait
+        wait = login_bucket_store.consume(f"email:{email}", *LOGIN_EMAIL_BUCKET, now)
+    except sqlite3.Error:
+        # A busy shared store fails closed: the client retries shortly.
+        app.logger.exception("Hastighetsbegränsningen kunde inte läsas")
+        _count_login_attempt("store_errors")
+        return 1.0
+    if wait:
+        _count_login_attempt("rejected_email")
+        return wait
+    _count_login_attempt("allowed")
+    return 0.0
+
+
+def sweep_subscriptions(today: Optional[date] = None, chunk_size: int = SUBSCRIPTION_SWEEP_CHUNK) -> Dict[str, int]:
+    """Renew or downgrade every subscription whose renewal date has passed.
+
+    Works through due rows shard by shard in chunks ordered by renewal_date,
+    committing each chunk separately so the write lock is only held briefly.
+    """
+    today_iso = (today or date.today()).isoformat()
+    next_renewal = ((today or date.today()) + timedelta(days=SUBSCRIPTION_PERIOD_DAYS)).isoformat()
+    totals = {"renewed": 0, "downgraded": 0}
+
+    for index in range(USER_SHARD_COUNT):
+        conn = get_shard_db(index)
+        cursor = conn.cursor()
+        while True:
+            cursor.execute(
+                """
+                SELECT user_id, auto_renew FROM subscriptions
+                WHERE renewal_date <= ?
+                ORDER BY renewal_date
+                LIMIT ?
+                """,
+                (today_iso, chunk_size),
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            # A user may renew or upgrade between the SELECT and the UPDATE, so
+            # each UPDATE re-checks the due date and skips rows that moved on.
+            renew: List[int] = []
+            downgrade: List[int] = []
+            now = int(time.time())
+            for row in rows:
+                if row["auto_renew"]:
+                    cursor.execute(
+                        "UPDATE subscriptions SET renewal_date = ? WHERE user_id = ? AND renewal_date <= ?",
+                        (next_renewal, row["user_id"], today_iso),
+                    )
+                    if cursor.rowcount:
+                        renew.append(row["user_id"])
+                else:
+                    cursor.execute(
+                        """
+                        UPDATE subscriptions SET tier = 'ad-supported', renewal_date = NULL
+                        WHERE user_id = ? AND renewal_date <= ?
+                        """,
+                        (row["user_id"], today_iso),
+                    )
+                    if cursor.rowcount:
+                        downgrade.append(row["user_id"])
+            cursor.executemany(
+                "INSERT INTO subscription_events (user_id, tier, created_at) VALUES (?, 'ad-supported', ?)",
+                [(user_id, now) for user_id in downgrade],
+            )
+            conn.commit()
+            totals["renewed"] += len(renew)
+            totals["downgraded"] += len(downgrade)
+
+        cursor.execute(
+            "DELETE FROM subscription_events WHERE created_at < ?",
+            (int(time.time()) - SUBSCRIPTION_EVENT_RETENTION,),
+        )
+        conn.commit()
+        conn.close()
+    return totals
+
+
+def poll_subscription_events() -> None:
+    """Deliver subscription changes recorded since the last poll to the listeners."""
+    _prune_tier_changes()
+    events: List[Tuple[int, str, int]] = []
+    for index in range(USER_SHARD_COUNT):
+        conn = get_shard_db(index)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, user_id, tier, created_at FROM subscription_events WHERE id > ? ORDER BY id",
+            (_last_subscription_event_ids.get(index, 0),),
+        )
+        rows = cursor.fetchall()
+        conn.close()
+        if rows:
+            _last_subscription_event_ids[index] = rows[-1]["id"]
+            events.extend((row["user_id"], row["tier"], row["created_at"]) for row in rows)
+
+    if not events:
+        return
+    for listener in subscription_listeners:
+        # The events are already consumed, so one failing listener must not
+        # keep them from the others.
+        try:
+            listener(events)
+        except Exception:
+            app.logger.exception("Prenumerationslyssnare misslyckades")
+
+
+def _expire_stale_tier_tokens(events: List[Tuple[int, str, int]]) -> None:
+    for user_id, _, created_at in events:
+        _tier_changed_at[user_id] = max(created_at, _tier_changed_at.get(user_id, 0))
+
+
+def _prune_tier_changes() -> None:
+    # Tokens issued before a change older than ACCESS_TOKEN_TTL have expired anyway.
+    cutoff = int(time.time()) - ACCESS_TOKEN_TTL
+    for user_id, changed_at in list(_tier_changed_at.items()):
+        if changed_at < cutoff:
+            del _tier_changed_at[user_id]
+
+
+subscription_listeners.append(_expire_stale_tier_tokens)
+
+
+def _run_scheduler() -> None:
+    last_sweep = 0.0
+    while True:
+        try:
+            if SUBSCRIPTION_SWEEPER and time.time() - last_sweep >= SUBSCRIPTION_SWEEP_INTERVAL:
+                last_sweep = time.time()
+                app.logger.info("Prenumerationssvep: %s", sweep_subscriptions())
+            poll_subscription_events()
+            poll_revoked_tokens()
+        except Exception:
+            # Any error, including one from a subscription listener, must not
+            # end the thread: this worker would silently stop polling.
+            app.logger.exception("Schemalagt jobb misslyckades")
+        time.sleep(SUBSCRIPTION_EVENT_POLL_INTERVAL)
+
+
+def start_scheduler() -> None:
+    global _scheduler_started
+    if _scheduler_started:
+        return
+    with _scheduler_lock:
+        if not _scheduler_started:
+            threading.Thread(target=_run_scheduler, name="scheduler", daemon=True).start()
+            _scheduler_started = True
+
+
+@app.cli.command("sweep-subscriptions")
+def sweep_subscriptions_command() -> None:
+    """Renew or downgrade all subscriptions that are due."""
+    init_db()
+    totals = sweep_subscriptions()
+    click.echo(f"Förnyade: {totals['renewed']}, nedgraderade: {totals['downgraded']}")
+
+
+def reshard_users(new_count: int, pattern: str, chunk_size: int = 5000) -> Dict[str, int]:
+    """Copy user-scoped rows from the current shards into ``new_count`` shards.
+
+    The target files must not overlap the current ones. Subscription events are
+    transient and are not copied. Switch USER_SHARD_COUNT/USER_SHARD_PATTERN
+    once the copy has finished.
+    """
+    sources = {shard_path(index) for index in range(USER_SHARD_COUNT)}
+    targets = [shard_path(index, new_count, pattern) for index in range(new_count)]
+    if sources & set(targets):
+        raise ValueError("Målfilerna överlappar de nuvarande shardfilerna.")
+
+    connections = [_connect(path) for path in targets]
+    for conn in connections:
+        conn.execute("PRAGMA journal_mode = WAL")
+        create_user_schema(conn.cursor())
+        conn.commit()
+
+    copied: Dict[str, int] = {}
+    for table in ("users", "user_preferences", "subscriptions", "user_ad_impressions"):
+        key = "id" if table == "users" else "user_id"
+        copied[table] = 0
+        for index in range(USER_SHARD_COUNT):
+            source = get_shard_db(index)
+            cursor = source.execute(f"SELECT * FROM {table}")
+            columns = [column[0] for column in cursor.description if table == "users" or column[0] != "id"]
+            insert = (
+                f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})"
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                batches: Dict[int, List[Tuple]] = {}
+                for row in rows:
+                    target = shard_for_user(row[key], new_count)
+                    batches.setdefault(target, []).append(tuple(row[column] for column in columns))
+                for target, batch in batches.items():
+                    connections[target].executemany(insert, batch)
+                    connections[target].commit()
+                copied[table] += len(rows)
+            source.close()
+
+    for conn in connections:
+        conn.close()
+    return copied
+
+
+@app.cli.command("reshard-users")
+@click.argument("shard_count", type=int)
+@click.option("--pattern", default=USER_SHARD_PATTERN, show_default=True, help="Filnamnsmall för nya shards.")
+def reshard_users_command(shard_count: int, pattern: str) -> None:
+    """Copy all user data into SHARD_COUNT new shard files."""
+    init_db()
+    try:
+        copied = reshard_users(shard_count, pattern)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    for table, count in copied.items():
+        click.echo(f"{table}: {count} rader")
+
+
+@app.cli.command("shard-stats")
+def shard_stats_command() -> None:
+    """Print row counts per user table and shard."""
+    for table in USER_TABLES:
+        counts = [row[0] for _, row in fan_out(f"SELECT COUNT(*) FROM {table}")]
+        click.echo(f"{table}: {sum(counts)} ({', '.join(map(str, counts))})")
+
+
+def claims_match_user(user_id) -> bool:
+    claims = g.get("claims")
+    return claims is not None and str(claims["sub"]) == str(user_id)
+
+
+@app.before_request
+def authenticate_request():
+    start_scheduler()
+    g.claims = None
+    header = request.headers.get("Authorization", "")
+    if header.startswith("Bearer "):
+        g.claims = verify_access_token(header[len("Bearer "):].strip())
+        if g.claims is None:
+            return jsonify({"error": "Ogiltig eller utgången token."}), 401
+
+    if g.claims is None and request.endpoint in AUTH_REQUIRED_ENDPOINTS:
+        return jsonify({"error": "Inloggning krävs."}), 401
+    return None
+
+
 @app.route("/api/users", methods=["POST"])
 def register_user():
     data = request.get_json(force=True) or {}
@@ -485,29 +1513,59 @@ def register_user():
     if not email or not password:
         return jsonify({"error": "E-post och lösenord krävs."}), 400
 
-    password_hash = generate_password_hash(password)
+    password_hash = hash_password(password)
     now = datetime.utcnow().isoformat()
 
     conn = get_db()
-    cursor = conn.cursor()
+    try:
+        user_id = conn.execute("INSERT INTO user_directory (email) VALUES (?)", (email,)).lastrowid
+        # Sign before committing anything, so a signing failure leaves the
+        # e-mail free for a retry.
+        access_token = issue_access_token(user_id, "ad-supported")
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        conn.close()
+        return jsonify({"error": "E-postadressen används redan."}), 409
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
+
+    shard = get_user_db(user_id)
+    cursor = shard.cursor()
     try:
         cursor.execute(
-            "INSERT INTO users (email, password_hash, name, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
-            (email, password_hash, name, now, now),
+            "INSERT INTO users (id, email, password_hash, name, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, email, password_hash, name, now, now),
         )
-        user_id = cursor.lastrowid
         cursor.execute(
             "INSERT OR REPLACE INTO subscriptions (user_id, tier, renewal_date) VALUES (?, ?, ?)",
             (user_id, "ad-supported", None),
         )
+        shard.commit()
+    except sqlite3.Error as error:
+        # Any failure on the shard must release the e-mail again, otherwise
+        # the address stays taken while no user row exists to log in with.
+        if shard.in_transaction:
+            shard.rollback()
+        conn.execute("DELETE FROM user_directory WHERE id = ?", (user_id,))
         conn.commit()
-    except sqlite3.IntegrityError:
-        conn.rollback()
-        return jsonify({"error": "E-postadressen används redan."}), 409
+        if isinstance(error, sqlite3.IntegrityError):
+            return jsonify({"error": "E-postadressen används redan."}), 409
+        raise
     finally:
+        shard.close()
         conn.close()
 
-    return jsonify({"user_id": user_id, "email": email, "name": name, "subscription": "ad-supported"}), 201
+    return jsonify({
+        "user_id": user_id,
+        "email": email,
+        "name": name,
+        "subscription": "ad-supported",
+        "access_token": access_token,
+        "expires_in": ACCESS_TOKEN_TTL,
+    }), 201
 
 
 @app.route("/api/login", methods=["POST"])
@@ -516,31 +1574,61 @@ def login():
     email = (data.get("email") or "").strip().lower()
     password = data.get("password")
 
+    # Reject before the password hash check so bursts cannot exhaust workers.
+    wait = check_login_rate_limit(email, request.remote_addr or "unknown")
+    if wait:
+        response = jsonify({"error": "För många inloggningsförsök. Försök igen senare."})
+        response.headers["Retry-After"] = str(int(wait) + 1)
+        return response, 429
+
     conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
-    row = cursor.fetchone()
+    entry = conn.execute("SELECT id FROM user_directory WHERE email = ?", (email,)).fetchone()
     conn.close()
 
-    if row is None or not password or not check_password_hash(row["password_hash"], password):
+    row = None
+    if entry is not None:
+        conn = get_user_db(entry["id"])
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT users.*, subscriptions.tier FROM users
+            LEFT JOIN subscriptions ON subscriptions.user_id = users.id
+            WHERE users.id = ?
+            """,
+            (entry["id"],),
+        )
+        row = cursor.fetchone()
+        conn.close()
+
+    if row is None or not password or not verify_password(row["password_hash"], password):
         return jsonify({"error": "Ogiltiga inloggningsuppgifter."}), 401
 
+    tier = row["tier"] or "ad-supported"
     return jsonify({
         "user_id": row["id"],
         "email": row["email"],
         "name": row["name"],
+        "subscription": tier,
+        "access_token": issue_access_token(row["id"], tier),
+        "expires_in": ACCESS_TOKEN_TTL,
     })
 
 
+@app.route("/api/logout", methods=["POST"])
+def logout():
+    revoke_token(g.claims)
+    return jsonify({"message": "Utloggad."})
+
+
 @app.route("/api/preferences", methods=["POST", "PUT"])
 def upsert_preferences():
     data = request.get_json(force=True) or {}
-    user_id = data.get("user_id")
+    user_id = data.get("user_id") or g.claims["sub"]
 
-    if not user_id:
-        return jsonify({"error": "user_id krävs."}), 400
+    if not claims_match_user(user_id):
+        return jsonify({"error": "Åtkomst nekad."}), 403
 
-    conn = get_db()
+    conn = get_user_db(user_id)
     cursor = conn.cursor()
     cursor.execute(
         """
@@ -571,7 +1659,10 @@ def upsert_preferences():
 
 @app.route("/api/preferences/<int:user_id>", methods=["GET"])
 def get_preferences(user_id: int):
-    conn = get_db()
+    if not claims_match_user(user_id):
+        return jsonify({"error": "Åtkomst nekad."}), 403
+
+    conn = get_user_db(user_id)
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM user_preferences WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
@@ -592,6 +1683,9 @@ def get_workout_plan():
     goal = request.args.get("goal")
     level = request.args.get("level")
 
+    if user_id and not claims_match_user(user_id):
+        return jsonify({"error": "Åtkomst nekad."}), 403
+
     if not goal and user_id:
         pref = _fetch_preferences(user_id)
         goal = pref.get("primary_goal") if pref else None
@@ -603,6 +1697,11 @@ def get_workout_plan():
     if not level:
         level = "beginner"
 
+    cache_key = ("workouts", goal, level)
+    cached = cached_catalog_response(cache_key)
+    if cached is not None:
+        return cached
+
     conn = get_db()
     cursor = conn.cursor()
     cursor.execute(
@@ -635,11 +1734,11 @@ def get_workout_plan():
             }
         )
 
-    return jsonify({
+    return store_catalog_response(cache_key, jsonify({
         "goal": goal,
         "level": level,
         "plan": plan,
-    })
+    }))
 
 
 @app.route("/api/plan/meals", methods=["GET"])
@@ -648,6 +1747,9 @@ def get_meal_plan():
     goal = request.args.get("goal")
     diet_type = request.args.get("diet_type")
 
+    if user_id and not claims_match_user(user_id):
+        return jsonify({"error": "Åtkomst nekad."}), 403
+
     if not goal and user_id:
         pref = _fetch_preferences(user_id)
         goal = pref.get("primary_goal") if pref else None
@@ -659,6 +1761,11 @@ def get_meal_plan():
     if not diet_type:
         diet_type = "standard"
 
+    cache_key = ("meals", goal, diet_type)
+    cached = cached_catalog_response(cache_key)
+    if cached is not None:
+        return cached
+
     conn = get_db()
     cursor = conn.cursor()
     cursor.execute(
@@ -691,12 +1798,12 @@ def get_meal_plan():
         )
 
     total_calories = sum(item["calories"] or 0 for meals in plan.values() for item in meals)
-    return jsonify({
+    return store_catalog_response(cache_key, jsonify({
         "goal": goal,
         "diet_type": diet_type,
         "total_daily_calories": total_calories,
         "plan": plan,
-    })
+    }))
 
 
 @app.route("/api/machines/identify", methods=["POST"])
@@ -704,9 +1811,29 @@ def identify_machine():
     data = request.get_json(force=True) or {}
     user_labels = data.get("labels") or []
     manual_hint = data.get("machine_name")
-
-    if not user_labels and not manual_hint:
-        return jsonify({"error": "Tillhandahåll minst ett identifierande label eller maskinnamn."}), 400
+    raw_embedding = data.get("embedding")
+
+    if not user_labels and not manual_hint and raw_embedding is None:
+        return jsonify({"error": "Tillhandahåll minst ett identifierande label, maskinnamn eller embedding."}), 400
+
+    if raw_embedding is not None:
+        embedding = parse_embedding(raw_embedding)
+        if embedding is None:
+            return jsonify({"error": "Ogiltig embedding."}), 400
+        try:
+            top_k = int(data.get("top_k") or 3)
+        except (TypeError, ValueError):
+            return jsonify({"error": "Ogiltigt top_k."}), 400
+        top_k = max(1, min(top_k, EMBEDDING_MAX_TOP_K))
+        neighbours = nearest_guides(embedding, top_k)
+        if neighbours is None:
+            return jsonify({"error": "Embeddingens dimension matchar inte referensvektorerna."}), 400
+        neighbours = [(guide_id, score) for guide_id, score in neighbours if score >= EMBEDDING_MIN_SIMILARITY]
+        matches = _embedding_matches(neighbours) if neighbours else None
+        if matches:
+            return jsonify(matches)
+        if not user_labels and not manual_hint:
+            return jsonify({"message": "Ingen tillräckligt lik maskin hittades."}), 404
 
     conn = get_db()
     cursor = conn.cursor()
@@ -734,20 +1861,51 @@ def identify_machine():
             "labels_tested": user_labels,
         }), 404
 
-    response = {
-        "machine_name": matched["machine_name"],
-        "primary_muscles": parse_json_field(matched["primary_muscles"]),
-        "cues": parse_json_field(matched["cues"]),
-        "instructions": parse_json_field(matched["instructions"]),
-        "label": matched["label"],
+    return jsonify(_guide_payload(matched))
+
+
+def _guide_payload(guide: sqlite3.Row) -> Dict:
+    return {
+        "machine_name": guide["machine_name"],
+        "primary_muscles": parse_json_field(guide["primary_muscles"]),
+        "cues": parse_json_field(guide["cues"]),
+        "instructions": parse_json_field(guide["instructions"]),
+        "label": guide["label"],
     }
 
-    return jsonify(response)
+
+def _embedding_matches(neighbours: List[Tuple[int, float]]) -> Optional[Dict]:
+    ids = [guide_id for guide_id, _ in neighbours]
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT * FROM machine_guides WHERE id IN ({','.join('?' * len(ids))})",
+        ids,
+    )
+    guides = {row["id"]: row for row in cursor.fetchall()}
+    conn.close()
+
+    # The index can lag behind deleted guides until it is rebuilt.
+    neighbours = [(guide_id, score) for guide_id, score in neighbours if guide_id in guides]
+    if not neighbours:
+        return None
+    matches = [
+        {"label": guides[guide_id]["label"], "machine_name": guides[guide_id]["machine_name"], "score": round(score, 4)}
+        for guide_id, score in neighbours
+    ]
+    best_id, best_score = neighbours[0]
+    response = _guide_payload(guides[best_id])
+    response["score"] = round(best_score, 4)
+    response["matches"] = matches
+    return response
 
 
 @app.route("/api/subscription/<int:user_id>", methods=["GET"])
 def get_subscription(user_id: int):
-    conn = get_db()
+    if not claims_match_user(user_id):
+        return jsonify({"error": "Åtkomst nekad."}), 403
+
+    conn = get_user_db(user_id)
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM subscriptions WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
@@ -762,47 +1920,66 @@ def get_subscription(user_id: int):
 @app.route("/api/subscription", methods=["POST"])
 def update_subscription():
     data = request.get_json(force=True) or {}
-    user_id = data.get("user_id")
+    user_id = data.get("user_id") or g.claims["sub"]
     tier = data.get("tier")
 
-    if not user_id or tier not in {"ad-supported", "premium"}:
+    if tier not in {"ad-supported", "premium"}:
         return jsonify({"error": "Ogiltiga prenumerationsuppgifter."}), 400
 
+    if not claims_match_user(user_id):
+        return jsonify({"error": "Åtkomst nekad."}), 403
+
     renewal_date: Optional[str]
     if tier == "premium":
-        renewal_date = (date.today() + timedelta(days=30)).isoformat()
+        renewal_date = (date.today() + timedelta(days=SUBSCRIPTION_PERIOD_DAYS)).isoformat()
     else:
         renewal_date = None
+    auto_renew = bool(data.get("auto_renew")) and tier == "premium"
 
-    conn = get_db()
+    conn = get_user_db(user_id)
     cursor = conn.cursor()
     cursor.execute(
-        "INSERT OR REPLACE INTO subscriptions (user_id, tier, renewal_date) VALUES (?, ?, ?)",
-        (user_id, tier, renewal_date),
+        "INSERT OR REPLACE INTO subscriptions (user_id, tier, renewal_date, auto_renew) VALUES (?, ?, ?, ?)",
+        (user_id, tier, renewal_date, int(auto_renew)),
+    )
+    # Every worker rejects the user's other tokens (other devices) issued
+    # before this event, so none of them keeps serving the old tier.
+    changed_at = int(time.time())
+    cursor.execute(
+        "INSERT INTO subscription_events (user_id, tier, created_at) VALUES (?, ?, ?)",
+        (user_id, tier, changed_at),
     )
     conn.commit()
     conn.close()
+    _expire_stale_tier_tokens([(g.claims["sub"], tier, changed_at)])
 
-    return jsonify({"message": "Prenumerationen uppdaterad.", "tier": tier, "renewal_date": renewal_date})
+    # The tier is embedded in the token, so swap the caller's token for one
+    # carrying the new tier.
+    revoke_token(g.claims)
+    return jsonify({
+        "message": "Prenumerationen uppdaterad.",
+        "tier": tier,
+        "renewal_date": renewal_date,
+        "auto_renew": auto_renew,
+        "access_token": issue_access_token(g.claims["sub"], tier),
+        "expires_in": ACCESS_TOKEN_TTL,
+    })
 
 
 @app.route("/api/ads/daily", methods=["POST"])
 def get_daily_ad():
     data = request.get_json(force=True) or {}
-    user_id = data.get("user_id")
-    if not user_id:
-        return jsonify({"error": "user_id krävs."}), 400
+    user_id = data.get("user_id") or g.claims["sub"]
+    if not claims_match_user(user_id):
+        return jsonify({"error": "Åtkomst nekad."}), 403
+
+    if g.claims["tier"] != "ad-supported":
+        return jsonify({"message": "Ingen reklam behövs för premium."})
 
     today = date.today().isoformat()
 
-    conn = get_db()
+    conn = get_user_db(user_id)
     cursor = conn.cursor()
-    cursor.execute("SELECT tier FROM subscriptions WHERE user_id = ?", (user_id,))
-    subscription = cursor.fetchone()
-
-    if subscription is None or subscription["tier"] != "ad-supported":
-        conn.close()
-        return jsonify({"message": "Ingen reklam behövs för premium."})
 
     cursor.execute(
         "SELECT * FROM user_ad_impressions WHERE user_id = ? AND served_on = ?",
@@ -812,10 +1989,11 @@ def get_daily_ad():
         conn.close()
         return jsonify({"message": "Dagens reklam har redan visats."})
 
-    cursor.execute(
+    catalog = get_db()
+    ads = catalog.execute(
         "SELECT * FROM ads WHERE target_tier = 'ad-supported' OR target_tier = 'all'"
-    )
-    ads = cursor.fetchall()
+    ).fetchall()
+    catalog.close()
 
     if not ads:
         conn.close()
@@ -833,13 +2011,112 @@ def get_daily_ad():
     return jsonify({"ad": ad, "served_on": today})
 
 
+@app.route("/api/users/<int:user_id>/export", methods=["GET"])
+def export_user_data(user_id: int):
+    if not claims_match_user(user_id):
+        return jsonify({"error": "Åtkomst nekad."}), 403
+
+    records = iter_user_export(user_id)
+    first = next(records, None)
+    if first is None:
+        return jsonify({"error": "Användaren hittades inte."}), 404
+
+    chunks = _chunk_lines(itertools.chain([first], records))
+    headers = {
+        "Content-Disposition": f"attachment; filename=user-{user_id}.ndjson",
+        "Vary": "Accept-Encoding",
+    }
+    if request.accept_encodings.best_match(["gzip"]):
+        chunks = gzip_stream(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(chunks), mimetype="application/x-ndjson", headers=headers)
+
+
+def iter_user_export(user_id: int) -> Iterator[str]:
+    """Yield one NDJSON line per record of a user's data, reading rows lazily."""
+    conn = get_user_db(user_id)
+    try:
+        profile = conn.execute(
+            "SELECT id, email, name, created_at, updated_at FROM users WHERE id = ?",
+            (user_id,),
+        ).fetchone()
+        if profile is None:
+            return
+        yield _export_line("profile", user_id, row_to_dict(profile))
+
+        sources = (
+            ("preferences", "SELECT * FROM user_preferences WHERE user_id = ?"),
+            ("subscription", "SELECT * FROM subscriptions WHERE user_id = ?"),
+            ("ad_impression", "SELECT ad_id, served_on FROM user_ad_impressions WHERE user_id = ? ORDER BY id"),
+            ("subscription_event", "SELECT tier, created_at FROM subscription_events WHERE user_id = ? ORDER BY id"),
+        )
+        for record_type, sql in sources:
+            for row in conn.execute(sql, (user_id,)):
+                yield _export_line(record_type, user_id, row_to_dict(row))
+    finally:
+        conn.close()
+
+
+def _export_line(record_type: str, user_id: int, data: Dict) -> str:
+    return app.json.dumps({"type": record_type, "user_id": user_id, "data": data}) + "\n"
+
+
+def _chunk_lines(lines: Iterator[str], size: int = EXPORT_CHUNK_SIZE) -> Iterator[bytes]:
+    buffer: List[bytes] = []
+    buffered = 0
+    for line in lines:
+        encoded = line.encode("utf-8")
+        buffer.append(encoded)
+        buffered += len(encoded)
+        if buffered >= size:
+            yield b"".join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def gzip_stream(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+@app.cli.command("export-users")
+@click.option("--user-id", "user_ids", type=int, multiple=True, help="Exportera endast dessa användare.")
+@click.option("--output", type=click.Path(dir_okay=False, writable=True), default="-", show_default=True)
+@click.option("--gzip", "compress", is_flag=True, help="Gzip-komprimera utdata.")
+def export_users_command(user_ids: Tuple[int, ...], output: str, compress: bool) -> None:
+    """Stream NDJSON exports for the given users, or every user."""
+    if not user_ids:
+        user_ids = (row["id"] for _, row in fan_out("SELECT id FROM users ORDER BY id"))
+    lines = (line for user_id in user_ids for line in iter_user_export(user_id))
+    chunks = _chunk_lines(lines)
+    if compress:
+        chunks = gzip_stream(chunks)
+    with click.open_file(output, "wb") as handle:
+        for chunk in chunks:
+            handle.write(chunk)
+
+
+@app.route("/api/metrics/login-limiter", methods=["GET"])
+def login_limiter_stats():
+    provided = request.headers.get("X-Metrics-Token", "")
+    if not METRICS_TOKEN or not hmac.compare_digest(provided.encode("utf-8"), METRICS_TOKEN.encode("utf-8")):
+        return jsonify({"error": "Hittades inte."}), 404
+    with _login_limiter_metrics_lock:
+        return jsonify(dict(login_limiter_metrics))
+
+
 @app.route("/api/health", methods=["GET"])
 def health_check():
     return jsonify({"status": "ok", "time": datetime.utcnow().isoformat()}), 200
 
 
 def _fetch_preferences(user_id: int) -> Optional[Dict]:
-    conn = get_db()
+    conn = get_user_db(user_id)
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM user_preferences WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
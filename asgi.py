@@ -0,0 +1,174 @@
+"""ASGI serving mode for the Flask routes in app.py.
+
+    uvicorn asgi:application --workers 2
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+
+The event loop accepts connections and reads request bodies, so idle or slow
+clients cost no thread. Each request then runs the unchanged Flask view on a
+bounded thread pool (ASYNC_DB_THREADS), where every thread keeps its own
+SQLite connections. Password hashing runs in a process pool
+(ASYNC_CPU_PROCESSES) so it does not compete with request threads for the
+GIL.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import io
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+import app as app_module
+
+ASYNC_DB_THREADS = int(os.environ.get("ASYNC_DB_THREADS", 16))
+ASYNC_CPU_PROCESSES = int(os.environ.get("ASYNC_CPU_PROCESSES", os.cpu_count() or 1))
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+
+class ClientDisconnected(Exception):
+    """The client went away before the request body was complete."""
+
+
+class FlaskASGI:
+    """Run a WSGI app behind ASGI on a bounded thread pool."""
+
+    def __init__(self, wsgi_app: Callable, db_threads: int = ASYNC_DB_THREADS, cpu_processes: int = ASYNC_CPU_PROCESSES):
+        self.wsgi_app = wsgi_app
+        self.db_threads = db_threads
+        self.cpu_processes = cpu_processes
+        self.executor = ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix="db")
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        try:
+            body = await self._read_body(receive)
+        except ClientDisconnected:
+            # Nobody is left to answer, and a truncated body must not reach a view.
+            return
+        if body is None:
+            await send({"type": "http.response.start", "status": 413, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._run_wsgi, scope, body, send, loop)
+
+    async def _lifespan(self, receive: Callable, send: Callable) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await asyncio.get_running_loop().run_in_executor(None, self._startup)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                if app_module.password_executor is not None:
+                    app_module.password_executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _startup(self) -> None:
+        # Fails fast when SECRET_KEY is missing instead of on the first login.
+        app_module.signing_key()
+        app_module.init_db()
+        app_module.REUSE_THREAD_CONNECTIONS = True
+        # Spawned workers avoid forking a process that already runs threads.
+        app_module.password_executor = ProcessPoolExecutor(
+            max_workers=self.cpu_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    @staticmethod
+    async def _read_body(receive: Callable):
+        chunks: List[bytes] = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnected()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > MAX_BODY_SIZE:
+                return None
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                break
+        return b"".join(chunks)
+
+    def _run_wsgi(self, scope: Dict[str, Any], body: bytes, send: Callable, loop: asyncio.AbstractEventLoop) -> None:
+        def send_sync(message: Dict[str, Any]) -> None:
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response_start: Dict[str, Any] = {}
+
+        def start_response(status: str, headers: List[Tuple[str, str]], exc_info=None):
+            response_start.update({
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+            })
+
+        result = self.wsgi_app(build_environ(scope, body), start_response)
+        try:
+            # Buffered Flask responses are a single chunk, sent in one message.
+            # Streamed ones (exports) are forwarded chunk by chunk.
+            started = False
+            for chunk in result:
+                if not chunk:
+                    continue
+                if not started:
+                    send_sync(response_start)
+                    started = True
+                send_sync({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not started:
+                send_sync(response_start)
+            send_sync({"type": "http.response.body", "body": b""})
+        finally:
+            close = getattr(result, "close", None)
+            if close is not None:
+                close()
+
+
+def build_environ(scope: Dict[str, Any], body: bytes) -> Dict[str, Any]:
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ: Dict[str, Any] = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for raw_name, raw_value in scope.get("headers", []):
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+            continue
+        if name == "CONTENT_LENGTH":
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+application = FlaskASGI(app_module.app)
@@ -0,0 +1,119 @@
+"""Load benchmark for comparing the sync (gunicorn) and async (ASGI) modes.
+
+Start the server in the mode to measure, then point the benchmark at it.
+Both modes need a shared SECRET_KEY so every worker accepts the tokens:
+
+    export SECRET_KEY=$(python -c "import secrets; print(secrets.token_hex(32))")
+    gunicorn -w 2 app:app -b 127.0.0.1:8000
+    uvicorn asgi:application --workers 2 --port 8001
+
+    python benchmark.py --url http://127.0.0.1:8000 --scenario mixed
+    python benchmark.py --url http://127.0.0.1:8001 --scenario mixed
+
+Each scenario runs the same request mix at a fixed concurrency and prints
+throughput and latency percentiles, so runs can be compared directly.
+Login attempts are capped by the login rate limiter; use the plan or ad
+scenarios for sustained load.
+"""
+
+from __future__ import annotations
+
+import json
+import secrets
+import statistics
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import click
+
+
+def _request(url: str, method: str = "GET", payload: Optional[Dict] = None, token: Optional[str] = None) -> Tuple[int, bytes]:
+    headers = {"Content-Type": "application/json", "Accept-Encoding": "gzip"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    req = urllib.request.Request(url, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=30) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.read()
+
+
+def _register(base: str) -> Tuple[int, str]:
+    email = f"bench-{secrets.token_hex(6)}@example.com"
+    status, body = _request(f"{base}/api/users", "POST", {"email": email, "password": "benchmark"})
+    if status != 201:
+        raise click.ClickException(f"Registrering misslyckades ({status}): {body[:200]!r}")
+    data = json.loads(body)
+    user_id, token = data["user_id"], data["access_token"]
+
+    # The mixed scenario reads these back, which 404s until they exist.
+    preferences = {"primary_goal": "get_fit", "experience_level": "beginner", "dietary_preference": "standard"}
+    status, body = _request(f"{base}/api/preferences", "POST", preferences, token=token)
+    if not 200 <= status < 300:
+        raise click.ClickException(f"Preferenserna kunde inte sparas ({status}): {body[:200]!r}")
+    return user_id, token
+
+
+def build_scenario(base: str, name: str) -> Callable[[int], int]:
+    user_id, token = _register(base)
+
+    def plan(i: int) -> int:
+        kind = "workouts" if i % 2 else "meals"
+        return _request(f"{base}/api/plan/{kind}?goal=get_fit", token=token)[0]
+
+    def ad(i: int) -> int:
+        return _request(f"{base}/api/ads/daily", "POST", {}, token=token)[0]
+
+    def register(i: int) -> int:
+        email = f"bench-{secrets.token_hex(8)}@example.com"
+        return _request(f"{base}/api/users", "POST", {"email": email, "password": "benchmark"})[0]
+
+    def mixed(i: int) -> int:
+        if i % 20 == 0:
+            return register(i)
+        if i % 4 == 0:
+            return ad(i)
+        if i % 4 == 1:
+            return _request(f"{base}/api/preferences/{user_id}", token=token)[0]
+        return plan(i)
+
+    return {"plan": plan, "ad": ad, "register": register, "mixed": mixed}[name]
+
+
+@click.command()
+@click.option("--url", default="http://127.0.0.1:5000", show_default=True, help="Serverns bas-URL.")
+@click.option("--scenario", type=click.Choice(["plan", "ad", "register", "mixed"]), default="mixed", show_default=True)
+@click.option("--requests", "total", default=2000, show_default=True)
+@click.option("--concurrency", default=64, show_default=True)
+def main(url: str, scenario: str, total: int, concurrency: int) -> None:
+    base = url.rstrip("/")
+    run = build_scenario(base, scenario)
+
+    def timed(i: int) -> Tuple[int, float]:
+        start = time.perf_counter()
+        status = run(i)
+        return status, (time.perf_counter() - start) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed, range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies: List[float] = sorted(latency for _, latency in results)
+    failures = Counter(status for status, _ in results if not 200 <= status < 300)
+    quantiles = statistics.quantiles(latencies, n=100)
+    click.echo(f"{scenario} mot {base}: {total} anrop, samtidighet {concurrency}")
+    click.echo(f"  genomströmning: {total / elapsed:.1f} anrop/s")
+    click.echo(f"  latens ms: p50 {quantiles[49]:.1f}  p95 {quantiles[94]:.1f}  p99 {quantiles[98]:.1f}  max {latencies[-1]:.1f}")
+    breakdown = ", ".join(f"{status}: {count}" for status, count in sorted(failures.items()))
+    click.echo(f"  misslyckade (ej 2xx): {sum(failures.values())}" + (f" ({breakdown})" if breakdown else ""))
+
+
+if __name__ == "__main__":
+    main()
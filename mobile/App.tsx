@@ -69,9 +69,14 @@ const machineHints = [
   { label: 'Roddmaskin', value: 'rowing machine' },
 ];
 
+let accessToken: string | null = null;
+
 const fetchJson = async <T,>(url: string, options?: RequestInit) => {
   const response = await fetch(url, {
-    headers: { 'Content-Type': 'application/json' },
+    headers: {
+      'Content-Type': 'application/json',
+      ...(accessToken ? { Authorization: `Bearer ${accessToken}` } : {}),
+    },
     ...options,
   });
 
@@ -113,10 +118,11 @@ export default function App() {
       setLoading(true);
       setError(null);
       if (authMode === 'register') {
-        const data = await fetchJson<{ user_id: number }>(`${API_BASE}/users`, {
+        const data = await fetchJson<{ user_id: number; access_token: string }>(`${API_BASE}/users`, {
           method: 'POST',
           body: JSON.stringify({ email, password, name }),
         });
+        accessToken = data.access_token;
         setUserId(data.user_id);
         await fetchJson(`${API_BASE}/preferences`, {
           method: 'POST',
@@ -133,10 +139,11 @@ export default function App() {
         });
         await fetchSubscription(data.user_id);
       } else {
-        const data = await fetchJson<{ user_id: number }>(`${API_BASE}/login`, {
+        const data = await fetchJson<{ user_id: number; access_token: string }>(`${API_BASE}/login`, {
           method: 'POST',
           body: JSON.stringify({ email, password }),
         });
+        accessToken = data.access_token;
         setUserId(data.user_id);
         await fetchSubscription(data.user_id);
       }
@@ -248,10 +255,11 @@ export default function App() {
       setLoading(true);
       setError(null);
       const nextTier = subscription?.tier === 'premium' ? 'ad-supported' : 'premium';
-      await fetchJson(`${API_BASE}/subscription`, {
+      const data = await fetchJson<{ access_token: string }>(`${API_BASE}/subscription`, {
         method: 'POST',
         body: JSON.stringify({ user_id: userId, tier: nextTier }),
       });
+      accessToken = data.access_token;
       await fetchSubscription();
     } catch (err: any) {
       setError(err.message);
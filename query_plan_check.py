@@ -0,0 +1,327 @@
+"""Query-plan regression check for the SQL in app.py.
+
+Builds a synthetic database at production scale, runs every literal SQL
+statement found in app.py through EXPLAIN QUERY PLAN and fails when one of
+them scans a large table. Each statement is also timed against the budgets in
+query_budgets.json.
+
+    python query_plan_check.py --db /tmp/fitness_coach_large.db
+
+The generated database is reused while its schema matches the one app.py
+creates; after a schema change (such as an added or dropped index) it is
+regenerated.
+"""
+
+from __future__ import annotations
+
+import ast
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from typing import Dict, Iterator, List, Tuple
+
+import click
+
+import app
+
+APP_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+BUDGETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_budgets.json")
+
+LARGE_TABLE_ROWS = 10_000
+SQL_PATTERN = r"(SELECT|INSERT|UPDATE|DELETE|WITH)\b"
+
+# Statements that are meant to read a whole table, with the reason why.
+ALLOWED_SCANS = {
+    "SELECT COUNT(*) FROM workouts": "Körs bara vid seedning.",
+    "SELECT COUNT(*) FROM meals": "Körs bara vid seedning.",
+    "SELECT COUNT(*) FROM machine_guides": "Körs bara vid seedning.",
+    "SELECT COUNT(*) FROM ads": "Körs bara vid seedning.",
+    "SELECT 1 FROM user_directory LIMIT 1": "Stoppar efter första raden.",
+    "SELECT id, email FROM users": "Engångsifyllnad av user_directory.",
+    "SELECT id FROM users ORDER BY id": "Bulkexport av alla användare.",
+    "SELECT guide_id, vector FROM machine_embeddings ORDER BY guide_id, id": "Bygger embeddingindexet.",
+    "SELECT COUNT(*), MAX(id) FROM machine_embeddings": "Ändringskontroll för embeddingindexet, högst en gång per TTL.",
+    "SELECT length(vector) FROM machine_embeddings LIMIT 1": "Stoppar efter första raden.",
+    "SELECT * FROM machine_guides": "Etikettmatchning mot hela guidekatalogen.",
+}
+
+GOALS = ["lose_weight", "get_fit", "build_strength"]
+LEVELS = ["beginner", "intermediate", "advanced", "all"]
+DIETS = ["standard", "vegetarian", "high_protein", "vegan"]
+MEAL_TYPES = ["breakfast", "lunch", "dinner", "snack"]
+
+
+def normalize(sql: str) -> str:
+    return " ".join(sql.split())
+
+
+def extract_statements(path: str = APP_SOURCE) -> List[str]:
+    """Return every literal SQL statement in ``path``, in source order."""
+    with open(path, encoding="utf-8") as handle:
+        tree = ast.parse(handle.read())
+
+    # Fragments of f-strings build dynamic SQL and cannot be planned on their own.
+    fragments = {
+        id(part) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr) for part in node.values
+    }
+    statements: List[str] = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and id(node) not in fragments:
+            sql = normalize(node.value)
+            if re.match(SQL_PATTERN, sql) and sql not in statements:
+                statements.append(sql)
+    return statements
+
+
+def _batches(rows: Iterator[Tuple], size: int = 50_000) -> Iterator[List[Tuple]]:
+    batch: List[Tuple] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(conn: sqlite3.Connection, sql: str, rows: Iterator[Tuple]) -> None:
+    for batch in _batches(rows):
+        conn.executemany(sql, batch)
+    conn.commit()
+
+
+def _apply_schema(conn: sqlite3.Connection, path: str) -> None:
+    app.create_catalog_schema(conn.cursor())
+    app.create_user_schema(conn.cursor())
+    app.SQLiteBucketStore(path)
+    conn.commit()
+
+
+def schema_fingerprint(conn: sqlite3.Connection) -> int:
+    """Hash the tables and indexes in ``conn`` into a value that fits PRAGMA user_version."""
+    rows = conn.execute("SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL ORDER BY type, name")
+    digest = hashlib.sha256("\n".join(f"{row[0]} {row[1]} {normalize(row[2])}" for row in rows).encode("utf-8"))
+    return int(digest.hexdigest()[:7], 16)
+
+
+def current_schema_fingerprint() -> int:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "schema.db")
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        try:
+            _apply_schema(conn, path)
+            return schema_fingerprint(conn)
+        finally:
+            conn.close()
+
+
+def is_current(path: str) -> bool:
+    """True when ``path`` was fully generated and still has the schema app.py creates."""
+    expected = current_schema_fingerprint()
+    conn = sqlite3.connect(path)
+    try:
+        stamped = conn.execute("PRAGMA user_version").fetchone()[0]
+        return stamped == expected and schema_fingerprint(conn) == expected
+    finally:
+        conn.close()
+
+
+def generate_database(path: str, scale: float, seed: int = 42) -> None:
+    """Fill ``path`` with the app schema and synthetic rows.
+
+    At scale 1.0 this is 2M users and 5M ad impressions plus tens of
+    thousands of workouts and meals.
+    """
+    rng = random.Random(seed)
+    users = int(2_000_000 * scale)
+    impressions = int(5_000_000 * scale)
+    catalog_rows = int(20_000 * scale)
+    today = date.today()
+
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    _apply_schema(conn, path)
+
+    created = today.isoformat()
+    _insert(conn, "INSERT INTO user_directory (id, email) VALUES (?, ?)",
+            ((i, f"user{i}@example.com") for i in range(1, users + 1)))
+    _insert(conn, "INSERT INTO users (id, email, password_hash, name, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            ((i, f"user{i}@example.com", "x", f"User {i}", created, created) for i in range(1, users + 1)))
+    _insert(conn, "INSERT INTO user_preferences (user_id, primary_goal, experience_level, dietary_preference) VALUES (?, ?, ?, ?)",
+            ((i, rng.choice(GOALS), rng.choice(LEVELS[:3]), rng.choice(DIETS))
+             for i in range(1, users + 1) if rng.random() < 0.7))
+    _insert(conn, "INSERT INTO subscriptions (user_id, tier, renewal_date, auto_renew) VALUES (?, ?, ?, ?)",
+            ((i, "premium", (today + timedelta(days=rng.randint(-5, 30))).isoformat(), rng.randint(0, 1))
+             if rng.random() < 0.2 else (i, "ad-supported", None, 0)
+             for i in range(1, users + 1)))
+    _insert(conn, "INSERT INTO user_ad_impressions (user_id, ad_id, served_on) VALUES (?, ?, ?)",
+            ((rng.randint(1, users), rng.randint(1, 50), (today - timedelta(days=rng.randint(0, 365))).isoformat())
+             for _ in range(impressions)))
+    _insert(conn, "INSERT INTO subscription_events (user_id, tier, created_at) VALUES (?, 'ad-supported', ?)",
+            ((rng.randint(1, users), int(time.time()) - rng.randint(0, 86_400)) for _ in range(users // 20)))
+    _insert(conn, "INSERT INTO rate_limits (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+            _rate_limit_rows(rng, users // 20, time.time()))
+    _insert(conn, "INSERT INTO workouts (goal, level, day, title, duration_minutes) VALUES (?, ?, ?, ?, ?)",
+            ((rng.choice(GOALS), rng.choice(LEVELS), rng.randint(1, 7), f"Pass {i}", 45) for i in range(catalog_rows)))
+    _insert(conn, "INSERT INTO meals (goal, diet_type, meal_type, title, calories) VALUES (?, ?, ?, ?, ?)",
+            ((rng.choice(GOALS), rng.choice(DIETS), rng.choice(MEAL_TYPES), f"Måltid {i}", 500) for i in range(catalog_rows)))
+    _insert(conn, "INSERT INTO machine_guides (label, machine_name) VALUES (?, ?)",
+            ((f"machine_{i}", f"Maskin {i}") for i in range(1, 1_001)))
+    _insert(conn, "INSERT INTO machine_embeddings (guide_id, vector) VALUES (?, ?)",
+            ((rng.randint(1, 1_000), bytes(512)) for _ in range(catalog_rows)))
+    _insert(conn, "INSERT INTO ads (title, body) VALUES (?, ?)",
+            ((f"Annons {i}", "Text") for i in range(1, 51)))
+    # Stamped last, so an interrupted run is regenerated next time.
+    conn.execute(f"PRAGMA user_version = {schema_fingerprint(conn)}")
+    conn.close()
+
+
+def _rate_limit_rows(rng: random.Random, count: int, now: float) -> Iterator[Tuple]:
+    """Login buckets at various refill stages.
+
+    The store deletes refilled rows every PRUNE_INTERVAL, so only buckets that
+    filled up within the last interval are left for the next prune.
+    """
+    capacity, rate = app.LOGIN_EMAIL_BUCKET
+    refill = capacity / rate
+    for i in range(1, count + 1):
+        while True:
+            updated = now - rng.uniform(0, refill)
+            tokens = rng.uniform(0, capacity - 1)
+            full_at = updated + (capacity - tokens) / rate
+            if full_at >= now - app.SQLiteBucketStore.PRUNE_INTERVAL:
+                break
+        yield f"email:user{i}@example.com", tokens, updated, full_at
+
+
+def sample_params(sql: str) -> Tuple:
+    """Bind realistic values to each ``?`` based on the column it is compared with."""
+    today = date.today().isoformat()
+    samples = {
+        "id": 123_457,
+        "user_id": 123_457,
+        "guide_id": 17,
+        "email": "user123457@example.com",
+        "served_on": today,
+        "renewal_date": today,
+        "created_at": int(time.time()) - app.SUBSCRIPTION_EVENT_RETENTION,
+        "goal": "get_fit",
+        "level": "beginner",
+        "diet_type": "vegetarian",
+        "label": "machine_17",
+        "key": "email:user17@example.com",
+        "full_at": time.time(),
+    }
+    params: List[object] = []
+    for match in re.finditer(r"(?:(\w+)\s*(?:=|<=|>=|<|>)\s*|(LIMIT)\s+)?\?", sql, re.IGNORECASE):
+        column, limit = match.group(1), match.group(2)
+        if limit:
+            params.append(500)
+        else:
+            # Values not tied to a known column are fresh, so inserts do not collide.
+            params.append(samples.get((column or "").lower(), 10**12))
+    return tuple(params)
+
+
+def large_tables(conn: sqlite3.Connection) -> Dict[str, int]:
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables}
+    return {table: count for table, count in counts.items() if count >= LARGE_TABLE_ROWS}
+
+
+def full_scans(conn: sqlite3.Connection, sql: str, tables: Dict[str, int]) -> List[str]:
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", sample_params(sql)).fetchall()
+    scans = []
+    for row in plan:
+        match = re.match(r"SCAN (\w+)", row[3])
+        if match and match.group(1) in tables:
+            scans.append(row[3])
+    return scans
+
+
+def time_statement(conn: sqlite3.Connection, sql: str, repeat: int = 3) -> float:
+    """Return the best of ``repeat`` runs in milliseconds; writes are rolled back."""
+    params = sample_params(sql)
+    best = float("inf")
+    for _ in range(repeat):
+        conn.execute("SAVEPOINT timing")
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        best = min(best, (time.perf_counter() - start) * 1000)
+        conn.execute("ROLLBACK TO timing")
+        conn.execute("RELEASE timing")
+    return best
+
+
+def load_budgets(path: str = BUDGETS_PATH) -> Tuple[float, Dict[str, float]]:
+    with open(path, encoding="utf-8") as handle:
+        budgets = json.load(handle)
+    return budgets["default_ms"], budgets.get("overrides", {})
+
+
+def check(db_path: str, statements: List[str]) -> List[str]:
+    default_ms, overrides = load_budgets()
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    tables = large_tables(conn)
+    failures: List[str] = []
+
+    for sql in statements:
+        try:
+            scans = full_scans(conn, sql, tables)
+        except sqlite3.Error as error:
+            failures.append(f"{sql}\n    kunde inte planeras: {error}")
+            continue
+        if scans and sql not in ALLOWED_SCANS:
+            failures.append(f"{sql}\n    fullständig tabellskanning: {'; '.join(scans)}")
+
+        elapsed = time_statement(conn, sql)
+        if sql in ALLOWED_SCANS:
+            # Whole-table reads grow with the data, so they are reported but not budgeted.
+            click.echo(f"SKAN {elapsed:8.2f} ms          {sql[:100]}")
+            continue
+        budget = overrides.get(sql, default_ms)
+        status = "OK  " if elapsed <= budget else "LÅNGSAM"
+        click.echo(f"{status} {elapsed:8.2f} ms / {budget:g} ms  {sql[:100]}")
+        if elapsed > budget:
+            failures.append(f"{sql}\n    {elapsed:.2f} ms överskrider budgeten {budget:g} ms")
+
+    conn.close()
+    return failures
+
+
+@click.command()
+@click.option("--db", "db_path", default="fitness_coach_large.db", show_default=True,
+              help="Syntetisk databas; genereras om filen saknas eller schemat har ändrats.")
+@click.option("--scale", default=1.0, show_default=True, help="Skalfaktor för genererad data.")
+def main(db_path: str, scale: float) -> None:
+    if os.path.exists(db_path) and not is_current(db_path):
+        click.echo(f"Schemat i {db_path} är inaktuellt; genererar om.")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+    if not os.path.exists(db_path):
+        click.echo(f"Genererar {db_path} (skala {scale:g}) ...")
+        generate_database(db_path, scale)
+
+    statements = extract_statements()
+    failures = check(db_path, statements)
+    if failures:
+        click.echo(f"\n{len(failures)} problem:", err=True)
+        for failure in failures:
+            click.echo(f"- {failure}", err=True)
+        sys.exit(1)
+    click.echo(f"\n{len(statements)} satser kontrollerade.")
+
+
+if __name__ == "__main__":
+    main()